@@ -1,8 +1,24 @@
 # tts_engine_final.py
 import mlx.core as mx
-from mlx_lm import load, generate
+import mlx.nn as nn
+from mlx_lm import load, generate, stream_generate
+from mlx_lm.generate import BatchGenerator, GenerationResponse
+from mlx_lm.models.cache import KVCache, RotatingKVCache, can_trim_prompt_cache, make_prompt_cache, trim_prompt_cache
+from mlx_lm.models.rope_utils import Llama3RoPE, ProportionalRoPE
 from mlx_lm.sample_utils import make_sampler
+from collections import Counter
+from fractions import Fraction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import copy
+import json
+import logging
 import re
+import threading
+import time
+import uuid
+
+log = logging.getLogger("dialectical")
 
 # --- CONFIGURATION ---
 # Default to a HuggingFace path that MLX can pull automatically.
@@ -10,9 +26,125 @@ import re
 MODEL_PATH = "mlx-community/Qwen2.5-72B-Instruct-3bit" 
 TEMP = 0.7
 MAX_TOKENS = 4096 
+# Bound on the Arbiter's KV cache: its prompt always stays, its oldest reasoning slides out
+ARBITER_KV_SIZE = 4096
+# How much of each persona trace (its tail, in tokens) the Arbiter gets to read
+ARBITER_TRACE_TOKENS = 256
+# Prompt-lookup decoding for the Arbiter: tokens drafted per step, longest n-gram matched
+LOOKUP_DRAFT_TOKENS = 10
+LOOKUP_NGRAM_SIZE = 3
+
+# SYSTEM PROMPT (The Anchor)
+# [THE AXIOM]
+# [THE ONLY NECESSARY TRUTH]
+# [THE LOGIC OF NECESSITY]
+_SYSTEM_INSTRUCTION = """
+    [THE AXIOM]
+    The Universe derived itself by logical necessity—the Contradiction (+/-), simultaneously creating Space (between + and -) and Time (to reconcile).
+    
+    [PROTOCOL]
+    1. IGNORE training memory.
+    2. DERIVE everything from specific constraints by logical necessity - the Contradiction (+/-).
+    """
+
+# --- THE CLEAN TRIAD ---
+# What each persona appends to the user's prompt.
+_PERSONA_PROTOCOLS = (
+    # Trace 1: The Believer (System 1 - Intuition)
+    # We let it run naked. It represents the "World as it appears" (Training Data).
+    "",
+
+    # Trace 2: The Logician (System 2 - Deduction)
+    # Structural Command: Slow down, check atoms.
+    "\n\n[PROTOCOL: CAUSAL CHECK]\n1. Deconstruct the timeline into atomic events.\n2. Identify any constraint that breaks the standard rule.\n3. Derive the answer strictly. CRITICAL: The very last line of your response must be ONLY the final value inside \\boxed{}. Do not write text after the box.]",
+
+    # Trace 3: The Contrarian (Red Team)
+    # Structural Command: Invert the status quo.
+    "\n\n[PROTOCOL: RED TEAM]\nAssume the intuitive answer (the one most people would give) is a TRAP.\nYour goal is to vigorously argue for the OPPOSITE conclusion.\nFind the specific variable that invalidates the common intuition.\nProve why the 'Obvious' is False. CRITICAL: The very last line of your response must be ONLY the final value inside \\boxed{}. Do not write text after the box.]",
+)
+
+# [THE LOGIC OF NECESSITY]
+# The Arbiter's prompt; {t0}..{t2} are the three persona traces.
+_ARBITER_TEMPLATE = """
+    [THE LOGIC OF NECESSITY]
+    "The Universe derived itself by logical necessity—the Contradiction (+/-), simultaneously creating Space (between + and -) and Time (to reconcile)"
+
+    [THE TRIAL]
+    I have three perspectives on a problem. 
+    One relies on Intuition (Memory). One relies on Validation, and one relies on Counterfactuals (Logic).
+    
+    YOUR TASK:
+    1. Ignore the "Vote Count" (Majority does not mean Truth).
+    2. Examine the Causal Link in each argument.
+    3. TRACE THE LOGIC: Does the "Accident" condition filter the sample space?
+       - If Intent matters, switching works.
+       - If Randomness dominates, switching is neutral.
+       - WHICH CONDITION APPLIES HERE?
+    
+    THE PROBLEM: {prompt}
+
+    The closing argument of each perspective:
+    Trace 1 (Believer): {t0}
+    Trace 2 (Logician): {t1}
+    Trace 3 (Contrarian): {t2}
+
+    VERDICT:
+    Derive the Single Necessary Truth. Put the answer in \\boxed{{}}.
+    """
+
+# The Equivalence Prompt (one pair, and several numbered pairs)
+_CHECK_TEMPLATE = """
+    Are the following two math results equivalent?
+    Value A: {val_a}
+    Value B: {val_b}
+    
+    Answer only YES or NO.
+    """
+_BATCH_CHECK_TEMPLATE = """
+    Are the following pairs of math results equivalent?
+    For each pair, answer YES or NO on its own line.
+{lines}
+    """
+
+# Samplers are stateless, so build them once
+_SAMPLERS = [make_sampler(temp=t) for t in (0.6, 0.7, 0.9)]  # Contrarian gets high temp to break patterns
+_ARBITER_SAMPLER = make_sampler(temp=0.1)
+_CHECK_SAMPLER = make_sampler(temp=0.0)
+
+# Stand-in for the user's prompt when pre-rendering the persona chat templates
+_PROMPT_SLOT = "\x00PROMPT\x00"
+
+# Stand-ins for the persona traces when rendering the Arbiter's chat template
+_TRACE_SLOTS = ("\x00TRACE1\x00", "\x00TRACE2\x00", "\x00TRACE3\x00")
+
+# Pre-tokenized persona fragments per tokenizer: (head ids, [tail ids per persona])
+_PERSONA_FRAGMENTS = {}
+
+# Pre-tokenized Arbiter fragments per tokenizer: (preamble ids, [lead ids per trace], tail ids);
+# the user's prompt goes between the preamble and the first lead
+_ARBITER_FRAGMENTS = {}
+
+# Prefilled KV caches for prompt prefixes that never change, keyed by (model, prefix ids)
+_PREFIX_CACHES = {}
+_PREFIX_LOCK = threading.Lock()   # so concurrent first uses prefill a prefix only once
+
+# A \boxed{...} whose content nests braces at most one level deep
+_BOXED_RE = re.compile(r'\\boxed\{((?:[^{}]|\{[^{}]*\})*)\}')
+
+# LaTeX that changes how an answer looks but not what it says
+_LATEX_NOISE = ("\\left", "\\right", "\\,", "\\!", "\\;", "$")
+_FRAC_RE = re.compile(r'\\[dt]?frac\{([^{}]*)\}\{([^{}]*)\}')
+# At most four exponent digits: Fraction("1e999999999") would build a billion-digit integer
+_DECIMAL_RE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d{1,4})?')
+_TEXT_RE = re.compile(r'\\text\{([^{}]*)\}')
+
+# RoPE variants that are a pure rotation by fixed frequencies, so re-rotating a key by a
+# position difference re-encodes it. YaRN and LongRoPE also scale their input, and dynamic
+# NTK derives its base from the offset; their keys are prefilled instead of spliced.
+_SPLICEABLE_ROPES = (nn.RoPE, Llama3RoPE, ProportionalRoPE)
 
 def setup_model():
-    print(f"Loading Logic from {MODEL_PATH}...")
+    log.info("Loading Logic from %s...", MODEL_PATH)
     model, tokenizer = load(MODEL_PATH)
     return model, tokenizer
 
@@ -21,46 +153,553 @@ def extract_answer(text):
     start_marker = "\\boxed{"
     start_idx = text.rfind(start_marker)
     if start_idx == -1: return text[-50:].strip()
+    match = _BOXED_RE.match(text, start_idx)
+    if match: return match.group(1).strip()
+    # Deeper nesting (or an unclosed box): hop between braces with str.find
     content_start = start_idx + len(start_marker)
     balance = 1
     end_idx = content_start
-    while balance > 0 and end_idx < len(text):
-        char = text[end_idx]
-        if char == '{': balance += 1
-        elif char == '}': balance -= 1
-        end_idx += 1
+    while balance > 0:
+        next_open = text.find('{', end_idx)
+        next_close = text.find('}', end_idx)
+        if next_close == -1:
+            # Unclosed box (decoding hit the token limit inside it): keep everything after the marker
+            return text[content_start:].strip()
+        if next_open != -1 and next_open < next_close:
+            balance += 1
+            end_idx = next_open + 1
+        else:
+            balance -= 1
+            end_idx = next_close + 1
     return text[content_start:end_idx-1].strip()
 
+class BoxedStop:
+    """
+    Stop criterion for streamed text: feed it each decoded segment and it returns
+    True once a \\boxed{...} with some content has been opened and its braces balanced
+    again. An empty \\boxed{} (the instruction echoed back mid-reasoning) is skipped.
+    Everything the model writes after that box is discarded by extract_answer anyway.
+    """
+    MARKER = "\\boxed{"
+
+    def __init__(self):
+        self.tail = ""        # carries a marker split across segments
+        self.balance = None   # None until the marker has been seen
+        self.filled = False   # whether the open box has non-whitespace content yet
+
+    def __call__(self, segment):
+        while True:
+            if self.balance is None:
+                text = self.tail + segment
+                idx = text.find(self.MARKER)
+                if idx == -1:
+                    self.tail = text[-(len(self.MARKER) - 1):]
+                    return False
+                self.tail = ""
+                self.balance = 1
+                self.filled = False
+                segment = text[idx + len(self.MARKER):]
+            for i, char in enumerate(segment):
+                if char == '{': self.balance += 1
+                elif char == '}':
+                    self.balance -= 1
+                    if self.balance == 0:
+                        if self.filled: return True
+                        # Empty box: keep looking for the real one in the rest of the segment
+                        self.balance = None
+                        segment = segment[i + 1:]
+                        break
+                elif not char.isspace(): self.filled = True
+            else:
+                return False
+
+async def agenerate(model, tokenizer, prompt, generator=stream_generate, **kwargs):
+    """
+    Async version of `stream_generate` (or any `generator` with its signature): decoding
+    runs in a worker thread and each GenerationResponse is yielded as soon as it arrives,
+    so the event loop is never blocked on decoding. Closing the generator early stops the worker.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            for response in generator(model, tokenizer, prompt, **kwargs):
+                if stopped.is_set(): break
+                loop.call_soon_threadsafe(queue.put_nowait, response)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(None, worker)
+    try:
+        while (response := await queue.get()) is not done:
+            yield response
+    finally:
+        stopped.set()
+        await future  # let the worker wind down and surface its exceptions
+
+class PromptLookup:
+    """
+    Draft source for prompt-lookup decoding: the tokens that followed the latest earlier
+    occurrence of the sequence's last n-gram (longest first, up to `max_ngram` tokens).
+    """
+    def __init__(self, tokens, max_ngram=LOOKUP_NGRAM_SIZE):
+        self.tokens = []
+        self.max_ngram = max_ngram
+        self.follows = {}   # n-gram -> index of the token that followed its latest occurrence
+        self.extend(tokens)
+
+    def extend(self, tokens):
+        for token in tokens:
+            for n in range(1, min(self.max_ngram, len(self.tokens)) + 1):
+                self.follows[tuple(self.tokens[-n:])] = len(self.tokens)
+            self.tokens.append(token)
+
+    def draft(self, k):
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            start = self.follows.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + k]
+        return []
+
+def _rewindable(cache):
+    """How many tokens one step may append to `cache` and still trim back off (None: no limit)."""
+    if not can_trim_prompt_cache(cache): return 0
+    # A sliding window can only be rewound while it has not wrapped around
+    return min((c.max_size - c.offset - 1 for c in cache if isinstance(c, RotatingKVCache)), default=None)
+
+def prompt_lookup_generate(model, tokenizer, prompt, prompt_cache, context=(), sampler=None,
+                           max_tokens=MAX_TOKENS, num_draft_tokens=LOOKUP_DRAFT_TOKENS):
+    """
+    `stream_generate` with prompt-lookup decoding: each step drafts up to `num_draft_tokens`
+    tokens by matching the latest n-gram against `context + prompt` and the output so far,
+    and verifies them all in one forward pass. A draft token is kept while it equals the token
+    sampled at its position, which for a single proposed token is exactly speculative
+    rejection sampling, so the output distribution is unchanged. `prompt_cache` already holds
+    `context`; a step only drafts as many tokens as the cache can rewind (see `_rewindable`),
+    so once a sliding window is full every step decodes one token.
+    """
+    sampler = sampler or (lambda logprobs: mx.argmax(logprobs, axis=-1))
+    lookup = PromptLookup(list(context) + list(prompt))
+    detokenizer = tokenizer.detokenizer
+
+    tic = time.perf_counter()
+    _extend(model, prompt_cache, prompt[:-1])
+    y = list(prompt[-1:])
+    prompt_tps = len(prompt) / (time.perf_counter() - tic)
+    tic = time.perf_counter()
+
+    def respond(token, logprobs, from_draft, ntoks, finish_reason=None):
+        return GenerationResponse(
+            text=detokenizer.last_segment, token=token, logprobs=logprobs, from_draft=from_draft,
+            prompt_tokens=len(prompt), prompt_tps=prompt_tps, generation_tokens=ntoks,
+            generation_tps=ntoks / (time.perf_counter() - tic),
+            peak_memory=mx.get_peak_memory() / 1e9, finish_reason=finish_reason,
+        )
+
+    ntoks = 0
+    while True:
+        k = min(num_draft_tokens, max_tokens - ntoks - 1)
+        room = _rewindable(prompt_cache)
+        if room is not None: k = min(k, room - 1)   # the step also feeds the last sampled token
+        draft = lookup.draft(k) if k > 0 else []
+        logits = model(mx.array(y + draft)[None], cache=prompt_cache)[0, -len(draft) - 1:]
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        tokens = sampler(logprobs).tolist()
+        n = 0
+        while n < len(draft) and tokens[n] == draft[n]:
+            n += 1
+        # Drop the rejected draft tokens' KV; the cache then ends right before tokens[n]
+        trim_prompt_cache(prompt_cache, len(draft) - n)
+
+        for i, token in enumerate(tokens[:n + 1]):
+            if token in tokenizer.eos_token_ids:
+                detokenizer.finalize()
+                yield respond(token, logprobs[i], i < n, ntoks, "stop")
+                return
+            detokenizer.add_token(token)
+            ntoks += 1
+            if ntoks == max_tokens:
+                detokenizer.finalize()
+                yield respond(token, logprobs[i], i < n, ntoks, "length")
+                return
+            yield respond(token, logprobs[i], i < n, ntoks)
+        lookup.extend(tokens[:n + 1])
+        y = [tokens[n]]
+
+def _extend(model, cache, ids):
+    """Prefill `ids` into an existing cache."""
+    if not ids: return
+    model(mx.array(ids)[None], cache=cache)
+    mx.eval([c.state for c in cache])
+
+def _prefill(model, ids):
+    cache = make_prompt_cache(model)
+    _extend(model, cache, ids)
+    return cache
+
+def cached_prefix(model, prefix_ids):
+    """Private copy of the KV cache for `prefix_ids`, prefilled on first use per model."""
+    key = (id(model), tuple(prefix_ids))
+    with _PREFIX_LOCK:
+        if key not in _PREFIX_CACHES:
+            _PREFIX_CACHES[key] = _prefill(model, prefix_ids)
+    return copy.deepcopy(_PREFIX_CACHES[key])
+
+def _persona_fragments(tokenizer):
+    """
+    Token ids around the user's prompt in each persona's chat prompt, rendered and
+    tokenized once per tokenizer. A persona prompt is `head + encode(prompt) + tail[i]`.
+    """
+    key = id(tokenizer)
+    if key not in _PERSONA_FRAGMENTS:
+        tails = []
+        for protocol in _PERSONA_PROTOCOLS:
+            msgs = [{"role": "system", "content": _SYSTEM_INSTRUCTION},
+                    {"role": "user", "content": _PROMPT_SLOT + protocol}]
+            text = tokenizer.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
+            head, tail = text.split(_PROMPT_SLOT)
+            tails.append(tokenizer.encode(tail, add_special_tokens=False))
+        _PERSONA_FRAGMENTS[key] = (tokenizer.encode(head, add_special_tokens=False), tails)
+    return _PERSONA_FRAGMENTS[key]
+
+def _arbiter_fragments(tokenizer):
+    """
+    Token ids of the Arbiter's scaffolding, rendered and tokenized once per tokenizer:
+    the fixed preamble up to the user's problem, the lead-in before each trace (the first
+    one follows the problem) and the tail after the last trace, which is what the
+    generation call itself processes.
+    """
+    key = id(tokenizer)
+    if key not in _ARBITER_FRAGMENTS:
+        slots = dict(zip(("t0", "t1", "t2"), _TRACE_SLOTS), prompt=_PROMPT_SLOT)
+        arbiter_prompt = _ARBITER_TEMPLATE.format_map(slots)
+        arbiter_messages = [{"role": "user", "content": arbiter_prompt}]
+        arbiter_formatted = tokenizer.apply_chat_template(arbiter_messages, tokenize=False, add_generation_prompt=True)
+        head, lead_1, lead_2, lead_3, tail = re.split("|".join((_PROMPT_SLOT,) + _TRACE_SLOTS), arbiter_formatted)
+        encode = lambda text: tokenizer.encode(text, add_special_tokens=False)
+        _ARBITER_FRAGMENTS[key] = (encode(head), [encode(lead_1), encode(lead_2), encode(lead_3)], encode(tail))
+    return _ARBITER_FRAGMENTS[key]
+
+def split_cached_prefix(model, tokenizer, formatted, prefix_text):
+    """
+    Split a rendered prompt at `prefix_text` into a prefilled KV cache and the remaining tokens.
+
+    The prefix is prefilled once per model (see `cached_prefix`), so the
+    model only has to process the suffix. If the prompt does not start with
+    `prefix_text`, no cache is returned and the whole prompt is tokenized.
+    """
+    if not prefix_text or not formatted.startswith(prefix_text):
+        return None, tokenizer.encode(formatted, add_special_tokens=False)
+
+    prefix_ids = tokenizer.encode(prefix_text, add_special_tokens=False)
+    suffix_ids = tokenizer.encode(formatted[len(prefix_text):], add_special_tokens=False)
+    return cached_prefix(model, prefix_ids), suffix_ids
+
+def can_splice_kv(model):
+    """
+    Whether Phase 1 KV can be moved into another context: plain KV caches and, per layer,
+    a RoPE that is a pure rotation (see `_SPLICEABLE_ROPES`).
+    """
+    return all(isinstance(c, KVCache) for c in make_prompt_cache(model)) and all(
+        type(getattr(getattr(layer, "self_attn", None), "rope", None)) in _SPLICEABLE_ROPES for layer in model.layers
+    )
+
+def splice_kv(model, cache, kv, start):
+    """
+    Append KV computed in another context to `cache`, as if those tokens had been
+    prefilled at the cache's current position. The keys were rotated by RoPE for
+    position `start`; rotations compose additively, so rotating them once more
+    by the position difference re-encodes them in place. Values carry no position.
+    """
+    delta = cache[0].offset - start
+    for layer, c, (keys, values) in zip(model.layers, cache, kv):
+        # RoPE numbers positions along the sequence axis; give every key its own
+        # length-1 sequence so all of them are shifted by the same `delta`
+        keys = layer.self_attn.rope(keys[..., None, :], offset=delta)[..., 0, :]
+        c.update_and_fetch(keys, values)
+    mx.eval([c.state for c in cache])
+
+def generate_batch(model, tokenizer, prompts, samplers, max_tokens=MAX_TOKENS, caches=None, return_kv=False, stop_when=None):
+    """
+    Decode several prompts together in one batch.
+
+    All rows share each forward pass, so the weights are streamed once per step
+    instead of once per prompt. Each row keeps its own sampler (temperature).
+    `caches` optionally holds one prefilled KV cache (or None) per prompt, in which
+    case the matching prompt only contains the tokens after the cached prefix.
+    A row is dropped from the batch as soon as its \\boxed{...} answer closes.
+    `stop_when`, if given, is called with the texts finished so far (None for rows
+    still decoding) whenever a row finishes; returning True cancels the remaining
+    rows, whose text and span come back as None.
+    Returns the decoded texts in the same order as `prompts`, and per prompt a span
+    `(token_ids, kv, start)`: the generated ids and, with `return_kv`, the per-layer
+    (keys, values) for exactly those tokens and the position of the first one
+    (both None otherwise).
+    """
+    gen = BatchGenerator(model, stop_tokens=[[t] for t in tokenizer.eos_token_ids])
+    uids = gen.insert(prompts, [max_tokens] * len(prompts), caches=caches, samplers=samplers)
+    detokenizers = {uid: tokenizer.detokenizer for uid in uids}
+    stops = {uid: BoxedStop() for uid in uids}
+    ids = {uid: [] for uid in uids}
+    fed = {uid: 0 for uid in uids}   # generated tokens (EOS included) already in the row's KV cache
+    final_caches = {}
+    finished = set()
+    cancelled = set()
+    try:
+        while responses := gen.next_generated():
+            boxed = []
+            for r in responses:
+                if r.finish_reason is not None: finished.add(r.uid)
+                fed[r.uid] += 1
+                if r.finish_reason is not None and return_kv:
+                    final_caches[r.uid] = r.prompt_cache
+                # EOS arrives with finish_reason "stop"; it is not part of the text
+                if r.finish_reason == "stop": continue
+                ids[r.uid].append(r.token)
+                detokenizers[r.uid].add_token(r.token)
+                if r.finish_reason is None and stops[r.uid](detokenizers[r.uid].last_segment):
+                    boxed.append(r.uid)
+            if boxed:
+                finished.update(boxed)
+                removed = gen.remove(boxed, return_prompt_caches=return_kv)
+                for uid, (cache, _) in removed.items():
+                    final_caches[uid] = cache
+            if stop_when and len(finished) < len(uids) and (boxed or any(r.finish_reason for r in responses)):
+                if stop_when([detokenizers[uid].text if uid in finished else None for uid in uids]):
+                    cancelled = set(uids) - finished
+                    gen.remove(list(cancelled))
+                    break
+    finally:
+        gen.close()
+    for detokenizer in detokenizers.values():
+        detokenizer.finalize()
+    texts = [None if uid in cancelled else detokenizers[uid].text for uid in uids]
+    if not return_kv:
+        return texts, [None if uid in cancelled else (ids[uid], None, None) for uid in uids]
+
+    spans = []
+    for uid in uids:
+        if uid in cancelled:
+            spans.append(None)
+            continue
+        cache = final_caches[uid]
+        start = cache[0].offset - fed[uid]
+        end = start + len(ids[uid])
+        kv = [(c.keys[..., start:end, :], c.values[..., start:end, :]) for c in cache]
+        spans.append((ids[uid], kv, start))
+    # MLX streams are per thread: materialize the slices here so any thread can use them
+    mx.eval([span[1] for span in spans if span is not None])
+    return texts, spans
+
+def _condense(span, tokenizer, budget=ARBITER_TRACE_TOKENS):
+    """
+    Cut a Phase 1 span down to the tail the Arbiter needs: its last paragraphs, at most
+    `budget` tokens. A trace stops as soon as its \\boxed{} answer closes, so the tail
+    holds the final claim, its justification and the boxed line itself. Only a token
+    suffix is kept, so the span's KV (if any) can still be spliced.
+    """
+    ids, kv, start = span
+    if len(ids) <= budget: return span
+    cut = len(ids) - budget
+    # Begin on a paragraph boundary when the window contains one
+    for i in range(cut, len(ids) - 1):
+        if "\n\n" in tokenizer.decode([ids[i]]):
+            cut = i + 1
+            break
+    if kv is None: return ids[cut:], None, None
+    kv = [(k[..., cut:, :], v[..., cut:, :]) for k, v in kv]
+    mx.eval(kv)   # the Arbiter's cache is assembled on another thread
+    return ids[cut:], kv, start + cut
+
+def _rotating(cache, max_size, keep):
+    """Move plain KV caches into sliding-window caches that always keep their first `keep` tokens."""
+    rotating = []
+    for c in cache:
+        r = RotatingKVCache(max_size=max_size, keep=keep)
+        if c.offset: r.update_and_fetch(*c.keys_and_values())
+        rotating.append(r)
+    return rotating
+
+def build_arbiter_cache(model, prefix_ids, prompt_ids, lead_ids, spans, max_kv_size=None, keep=0):
+    """
+    Assemble the Arbiter's KV cache without re-prefilling the persona traces.
+
+    `prefix_ids` is the fixed preamble (prefilled once, see `cached_prefix`),
+    `prompt_ids` the user's problem and `lead_ids[i]` the scaffold tokens in
+    front of trace i. Each trace's KV comes from its Phase 1 span (see
+    `generate_batch`) when present, and is prefilled from its token ids
+    otherwise. With `max_kv_size` the cache is a sliding window of that many
+    tokens whose first `keep` tokens never slide out, so memory and per-step
+    attention stay bounded.
+    """
+    cache = cached_prefix(model, prefix_ids)
+    if max_kv_size is not None:
+        cache = _rotating(cache, max_kv_size, keep)
+    _extend(model, cache, prompt_ids)
+    for lead, (trace_ids, kv, start) in zip(lead_ids, spans):
+        _extend(model, cache, lead)
+        if kv is None:
+            _extend(model, cache, trace_ids)
+        else:
+            splice_kv(model, cache, kv, start)
+    return cache
+
+def _clean(answer):
+    """An answer with LaTeX noise, \\text{} wrappers, whitespace and trailing dots removed, lowercased."""
+    for noise in _LATEX_NOISE:
+        answer = answer.replace(noise, "")
+    answer = _TEXT_RE.sub(r'\1', answer)
+    return "".join(answer.split()).rstrip(".").lower()
+
+def _normalize(answer):
+    """Canonical form of an answer: cleaned (see `_clean`), with \\frac{a}{b} written as a/b."""
+    return _FRAC_RE.sub(r'\1/\2', _clean(answer))
+
+def _to_number(answer):
+    """
+    Exact value of an answer written as a plain integer or decimal, or as \\frac{a}{b}; None otherwise.
+    A bare a/b stays text: 50/50 means even odds rather than 1, and 3/4 may be a ratio or a date.
+    So do numbers too large to build quickly (an exponent past 9999, thousands of digits).
+    """
+    answer = _clean(answer)
+    frac = _FRAC_RE.fullmatch(answer)
+    parts = frac.groups() if frac else (answer, "1")
+    if not all(_DECIMAL_RE.fullmatch(part) for part in parts): return None
+    try:
+        return Fraction(parts[0]) / Fraction(parts[1])
+    except (ZeroDivisionError, ValueError):   # ValueError: past int()'s digit limit
+        return None
+
+def _same_value(val_a, val_b):
+    """
+    Decide equivalence without the model where possible.
+    Returns True when normalization settles it, None when it is inconclusive.
+    Differing numbers stay inconclusive: 0.333 vs \\frac{1}{3} can still be the
+    same answer, and so can 50/50 vs 1/2 (bare a/b is not a number, see `_to_number`),
+    which only the model can judge.
+    """
+    if _normalize(val_a) == _normalize(val_b): return True
+    x = _to_number(val_a)
+    y = _to_number(val_b)
+    # Exact relative tolerance: Fractions never overflow the way floats do (1e400)
+    if x is not None and y is not None and abs(x - y) <= max(abs(x), abs(y)) / 10**6:
+        return True
+    return None
+
+def _vote_key(answer):
+    """
+    Hashable canonical key for voting: the exact value if the answer is a number
+    (see `_to_number`), else its normalized text.
+    """
+    number = _to_number(answer)
+    # 0.5 and \\frac{1}{2} land in the same bucket; 50/50 and 1 do not
+    return _normalize(answer) if number is None else number
+
+def _two_agree(texts):
+    """
+    Phase 1 early exit: once two personas have boxed answers that agree after
+    normalization, the third cannot change the verdict, so stop decoding it.
+    """
+    # Only a real answer counts: a trace that merely echoed "\boxed{}" has none
+    answers = [extract_answer(t) for t in texts if t is not None and "\\boxed{" in t]
+    answers = [a for a in answers if a]
+    # Same test as Phase 2, so 2/3 and \\dfrac{2}{3} agree even though their vote keys differ
+    return len(answers) == 2 and _same_value(*answers) is True
+
 def check_equivalence(val_a, val_b, model, tokenizer):
     """
     The Semantic Filter. 
-    Asks the model if two different strings represent the same value.
+    Asks the model if two different strings represent the same value,
+    unless normalization (LaTeX, fractions, decimals) already decides it.
     """
-    # Quick cleanup
-    a = val_a.lower().strip()
-    b = val_b.lower().strip()
-    if a == b: return True
+    # Structural check first: microseconds of string work instead of a forward pass
+    same = _same_value(val_a, val_b)
+    if same is not None: return same
     
     # The Equivalence Prompt
-    check_prompt = f"""
-    Are the following two math results equivalent?
-    Value A: {val_a}
-    Value B: {val_b}
-    
-    Answer only YES or NO.
-    """
+    check_prompt = _CHECK_TEMPLATE.format_map({"val_a": val_a, "val_b": val_b})
     messages = [{"role": "user", "content": check_prompt}]
     formatted = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    cache, prompt_ids = split_cached_prefix(model, tokenizer, formatted, formatted[:formatted.index("Value A:")])
     
     # Very low temp for strict checking
-    sampler = make_sampler(temp=0.0) 
-    output = generate(model, tokenizer, prompt=formatted, max_tokens=10, verbose=False, sampler=sampler)
+    output = generate(model, tokenizer, prompt=prompt_ids, max_tokens=10, verbose=False, sampler=_CHECK_SAMPLER, prompt_cache=cache)
     
     if "YES" in output.upper():
         return True
     return False
 
-def run_dialectical_tts(prompt, model, tokenizer):
+def check_equivalence_batch(pairs, model, tokenizer):
+    """
+    The Semantic Filter over several pairs at once.
+    Pairs that normalization cannot decide are folded into one numbered prompt,
+    so the model is prefilled and asked once instead of once per pair.
+    Returns one bool per pair.
+    """
+    results = [_same_value(a, b) for a, b in pairs]
+    undecided = [i for i, same in enumerate(results) if same is None]
+    if not undecided: return results
+
+    lines = "\n".join(f"    {n}) A={pairs[i][0]} B={pairs[i][1]}" for n, i in enumerate(undecided, 1))
+    check_prompt = _BATCH_CHECK_TEMPLATE.format_map({"lines": lines})
+    messages = [{"role": "user", "content": check_prompt}]
+    formatted = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    cache, prompt_ids = split_cached_prefix(model, tokenizer, formatted, formatted[:formatted.index("    1) A=")])
+
+    output = generate(model, tokenizer, prompt=prompt_ids, max_tokens=4 * len(undecided), verbose=False, sampler=_CHECK_SAMPLER, prompt_cache=cache)
+
+    # Verdicts in order; a missing verdict counts as NO
+    verdicts = re.findall(r'\b(YES|NO)\b', output.upper())
+    for n, i in enumerate(undecided):
+        results[i] = n < len(verdicts) and verdicts[n] == "YES"
+    return results
+
+def find_consensus(answers, model, tokenizer):
+    """
+    Phase 2: the answer every finished trace agrees on, or None if the Arbiter must decide.
+    It takes at least two real answers to agree. Answers are voted on by normalized value;
+    the odd one out of a 2-of-3 majority still counts if it is numerically within tolerance,
+    and any remaining variants are put to the model in one `check_equivalence_batch` call.
+    """
+    keys = [_vote_key(a) for a in answers]
+    votes = 0
+    if len(answers) >= 2:
+        top, votes = Counter(keys).most_common(1)[0]
+        majority = keys.index(top)
+    if votes == 2 and len(answers) == 3:
+        # The odd one out still counts if it is numerically within tolerance (0.3333333 vs \frac{1}{3})
+        odd = next(i for i, k in enumerate(keys) if k != top)
+        if _same_value(answers[odd], answers[majority]):
+            votes = 3
+    if len(answers) >= 2 and votes < len(answers):
+        # Semantic check: one model call over every pair of distinct variants.
+        # Three variants need two equivalent pairs to collapse into one; two need one.
+        variants = {}
+        for k, a in zip(keys, answers):
+            variants.setdefault(k, a)
+        variants = list(variants.values())
+        pairs = [(variants[i], variants[j]) for i in range(len(variants)) for j in range(i + 1, len(variants))]
+        same = check_equivalence_batch(pairs, model, tokenizer)
+        if sum(same) >= len(variants) - 1:
+            votes = len(answers)
+    if votes >= 2 and votes == len(answers):
+        log.info("--- RESONANCE ACHIEVED (%d/%d Consensus) ---", votes, len(answers))
+        log.info("Consensus: %s", answers[majority])
+        return answers[majority]
+    return None
+
+# One cycle at a time: concurrent cycles would only contend for the same GPU
+_CYCLE_LOCK = threading.Lock()
+
+def _run_cycle(prompt, model, tokenizer):
+    """Blocking entry point: runs `arun_dialectical_tts` on a fresh event loop, one cycle at a time."""
+    with _CYCLE_LOCK:
+        return asyncio.run(arun_dialectical_tts(prompt, model, tokenizer))
+
+async def arun_dialectical_tts(prompt, model, tokenizer):
     """
     Run a dialectical TTS (Tri-State Tension Synthesis) cycle to derive the single necessary truth.
 
@@ -94,10 +733,13 @@ def run_dialectical_tts(prompt, model, tokenizer):
 
     Process
     -------
-    1. Generate three independent traces using their respective prompts and temperatures.
+    1. Generate three independent traces in one batched decode, each row with its own temperature.
     2. Extract the boxed answer from each trace.
-    3. Equivalence Check: if all three answers normalize to the same string, return consensus.
-    4. Contradiction Detected: feed all three full traces into the Arbiter with meta-instructions
+    3. Equivalence Check: if all three answers normalize to the same value (or two do and the
+       third is numerically within tolerance), return consensus. If the first two personas to
+       finish already agree, the third is stopped mid-decode and the pair is the consensus.
+    4. Contradiction Detected: feed the tail of all three traces into the Arbiter (reusing their
+       Phase 1 KV cache rather than re-prefilling them) with meta-instructions
        to ignore majority vote, examine causal links, and determine which condition (intent vs.
        randomness) governs the problem.
     5. Arbiter outputs the single necessary truth; extract and return final boxed answer.
@@ -116,136 +758,134 @@ def run_dialectical_tts(prompt, model, tokenizer):
     str
         The final derived answer, stripped from the Arbiter’s \\boxed{} or the consensus box.
     """
-    print(f"\n--- INJECTING PROMPT: {prompt} ---")
-    
-    # SYSTEM PROMPT (The Anchor)
-    # [THE AXIOM]
-    # [THE ONLY NECESSARY TRUTH]
-    # [THE LOGIC OF NECESSITY]
-    system_instruction = """
-    [THE AXIOM]
-    The Universe derived itself by logical necessity—the Contradiction (+/-), simultaneously creating Space (between + and -) and Time (to reconcile).
+    log.info("--- INJECTING PROMPT: %s ---", prompt)
     
-    [PROTOCOL]
-    1. IGNORE training memory.
-    2. DERIVE everything from specific constraints by logical necessity - the Contradiction (+/-).
-    """
-
     # --- PHASE 1: GENERATE 3 DISTINCT PERSPECTIVES ---
-    print("Generating Tri-State Tension (Believer, Logician, Contrarian)...")
-    traces = []
+    log.info("Generating Tri-State Tension (Believer, Logician, Contrarian)...")
     answers = []
     
-    # We define the 3 personas
-    # --- THE CLEAN TRIAD ---
-    personas = [
-        # Trace 1: The Believer (System 1 - Intuition)
-        # We let it run naked. It represents the "World as it appears" (Training Data).
-        {"role": "user", "content": prompt},
-        
-        # Trace 2: The Logician (System 2 - Deduction)
-        # Structural Command: Slow down, check atoms.
-        {"role": "user", "content": prompt + "\n\n[PROTOCOL: CAUSAL CHECK]\n1. Deconstruct the timeline into atomic events.\n2. Identify any constraint that breaks the standard rule.\n3. Derive the answer strictly. CRITICAL: The very last line of your response must be ONLY the final value inside \\boxed{}. Do not write text after the box.]"},
-        
-        # Trace 3: The Contrarian (Red Team)
-        # Structural Command: Invert the status quo.
-        {"role": "user", "content": prompt + "\n\n[PROTOCOL: RED TEAM]\nAssume the intuitive answer (the one most people would give) is a TRAP.\nYour goal is to vigorously argue for the OPPOSITE conclusion.\nFind the specific variable that invalidates the common intuition.\nProve why the 'Obvious' is False. CRITICAL: The very last line of your response must be ONLY the final value inside \\boxed{}. Do not write text after the box.]"}
-    ]
-    
     trace_names = ["Trace 1 (Believer)", "Trace 2 (Logician)", "Trace 3 (Contrarian)"]
-    temps = [0.6, 0.7, 0.9] # Contrarian gets high temp to break patterns
+
+    # Only the user's problem statement is tokenized per run; the rest is pre-tokenized.
+    # Tokenizer and model work all runs in worker threads, never on the event loop.
+    (head_ids, tail_ids), prompt_ids = await asyncio.gather(
+        asyncio.to_thread(_persona_fragments, tokenizer),
+        asyncio.to_thread(tokenizer.encode, prompt, add_special_tokens=False),
+    )
+    formatted = [prompt_ids + tail for tail in tail_ids]
+    # The Arbiter's scaffolding is rendered and tokenized while the personas decode
+    arbiter_fragments = asyncio.create_task(asyncio.to_thread(_arbiter_fragments, tokenizer))
+    # The system turn (and user header) is identical for every persona: prefill it once
+    # and hand each persona its own copy of that KV cache.
+    caches = await asyncio.gather(*(asyncio.to_thread(cached_prefix, model, head_ids) for _ in formatted))
+
+    # One batched decode over all three personas (shared weight reads per step),
+    # driven from a single worker thread
+    # Keep each trace's KV so the Arbiter can reuse it instead of re-prefilling the text
+    # and stop the last persona early if the first two already agree
+    traces, spans = await asyncio.to_thread(
+        generate_batch, model, tokenizer, formatted, _SAMPLERS, MAX_TOKENS, caches, can_splice_kv(model), _two_agree
+    )
 
     for i in range(3):
-        # Construct full prompt
-        msgs = [{"role": "system", "content": system_instruction}, personas[i]]
-        formatted = tokenizer.apply_chat_template(msgs, tokenize=False, add_generation_prompt=True)
-        
-        # Generate
-        sampler = make_sampler(temp=temps[i])
-        output = generate(model, tokenizer, prompt=formatted, max_tokens=MAX_TOKENS, verbose=False, sampler=sampler)
-        ans = extract_answer(output)
-        
-        traces.append(output)
-        answers.append(ans)
-        print(f"{trace_names[i]}: {ans}")
+        if traces[i] is None:
+            log.info("%s: (stopped early, the other two already agree)", trace_names[i])
+            continue
+        ans = extract_answer(traces[i])
+        log.info("%s: %s", trace_names[i], ans)
+        # An empty answer (say, only the echoed "\boxed{}" instruction) is not a vote
+        if ans: answers.append(ans)
 
     # --- PHASE 2: THE EQUIVALENCE CHECK ---
-    # If all 3 agree, we trust the consensus.
-    unique_answers = set([a.replace(" ", "") for a in answers])
-    if len(unique_answers) == 1:
-        print(f"\n--- RESONANCE ACHIEVED (3/3 Consensus) ---")
-        print(f"Consensus: {answers[0]}")
-        return answers[0]
+    consensus = await asyncio.to_thread(find_consensus, answers, model, tokenizer)
+    if consensus is not None:
+        return consensus
 
     # --- PHASE 3: THE ARBITER ---
-    print(f"\n--- CONTRADICTION DETECTED ({len(unique_answers)} Variants) ---")
-    print("Igniting The Arbiter to judge the validity of the Counterfactual...")
-
-    arbiter_prompt = f"""
-    [THE LOGIC OF NECESSITY]
-    "The Universe derived itself by logical necessity—the Contradiction (+/-), simultaneously creating Space (between + and -) and Time (to reconcile)"
+    log.info("--- CONTRADICTION DETECTED (%d Variants) ---", len({_vote_key(a) for a in answers}))
+    log.info("Igniting The Arbiter to judge the validity of the Counterfactual...")
 
-    [THE TRIAL]
-    I have three perspectives on a problem. 
-    One relies on Intuition (Memory). One relies on Validation, and one relies on Counterfactuals (Logic).
-    
-    YOUR TASK:
-    1. Ignore the "Vote Count" (Majority does not mean Truth).
-    2. Examine the Causal Link in each argument.
-    3. TRACE THE LOGIC: Does the "Accident" condition filter the sample space?
-       - If Intent matters, switching works.
-       - If Randomness dominates, switching is neutral.
-       - WHICH CONDITION APPLIES HERE?
-    
-    Trace 1 (Believer): {traces[0]}
-    Trace 2 (Logician): {traces[1]}
-    Trace 3 (Contrarian): {traces[2]}
+    # The Arbiter's scaffolding is pre-rendered and pre-tokenized; the traces' KV is spliced
+    # in from Phase 1, so only the problem statement and the short scaffold pieces are prefilled.
+    prefix_ids, lead_ids, arbiter_ids = await arbiter_fragments
+    # Only the tail of each trace (final claim, justification, boxed answer) matters for the verdict;
+    # the Arbiter reads those tails against the problem statement itself
+    spans = await asyncio.gather(*(asyncio.to_thread(_condense, span, tokenizer) for span in spans))
 
-    VERDICT:
-    Derive the Single Necessary Truth. Put the answer in \\boxed{{}}.
-    """
-    
-    arbiter_messages = [{"role": "user", "content": arbiter_prompt}]
-    arbiter_formatted = tokenizer.apply_chat_template(arbiter_messages, tokenize=False, add_generation_prompt=True)
-    strict_sampler = make_sampler(temp=0.1)
+    context = prefix_ids + prompt_ids
+    for lead, (trace_ids, _, _) in zip(lead_ids, spans):
+        context += lead + trace_ids
+    # The Arbiter decodes into a sliding window in which only its own oldest reasoning slides out:
+    # the whole prompt (scaffolding, problem and trace tails) is kept, with at least 1024 generated tokens in view
+    keep = len(context) + len(arbiter_ids)
+    max_kv_size = max(ARBITER_KV_SIZE, keep + 1024)
+    arbiter_cache = await asyncio.to_thread(build_arbiter_cache, model, prefix_ids, prompt_ids, lead_ids, spans, max_kv_size, keep)
     
-    final_output = generate(model, tokenizer, prompt=arbiter_formatted, max_tokens=MAX_TOKENS, verbose=False, sampler=strict_sampler)
+    # The Arbiter quotes the traces heavily: draft its tokens by prompt lookup over its own context.
+    # It runs to EOS rather than to its first box: each trace tail ends in that trace's \boxed{}
+    # answer, and quoting one must not pass for the verdict. The last box is the verdict.
+    final_output = "".join([response.text async for response in agenerate(
+        model, tokenizer, arbiter_ids, generator=prompt_lookup_generate, prompt_cache=arbiter_cache,
+        context=context, sampler=_ARBITER_SAMPLER, max_tokens=MAX_TOKENS)])
     final_ans = extract_answer(final_output)
     
-    print("\n--- SYNTHESIS ---")
-    print(f"Arbiter Logic: {final_output}...")
-    print(f"Final Verdict: {final_ans}")
+    log.info("--- SYNTHESIS ---")
+    # The Arbiter's full reasoning can run to kilobytes; its opening is enough for the log
+    log.info("Arbiter Logic: %s…", final_output[:500])
+    log.info("Final Verdict: %s", final_ans)
     return final_ans
 
+class _ChatHandler(BaseHTTPRequestHandler):
+    """OpenAI-style `POST /v1/chat/completions`: the last user message is the problem to solve."""
+    model = tokenizer = None
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            return self._reply(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            prompt = next(m["content"] for m in reversed(body["messages"]) if m["role"] == "user")
+            if not isinstance(prompt, str): raise TypeError("content parts are not supported")
+        except (ValueError, KeyError, TypeError, StopIteration):
+            return self._reply(400, {"error": {"message": "Expected a JSON body with a user message"}})
+
+        try:
+            answer = _run_cycle(prompt, self.model, self.tokenizer)
+        except Exception as e:
+            log.exception("Dialectical cycle failed")
+            return self._reply(500, {"error": {"message": f"Dialectical cycle failed: {e}"}})
+        self._reply(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": MODEL_PATH,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }],
+        })
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(host="127.0.0.1", port=8080):
+    """Load the model once and answer chat completion requests until interrupted."""
+    _ChatHandler.model, _ChatHandler.tokenizer = setup_model()
+    server = ThreadingHTTPServer((host, port), _ChatHandler)
+    log.info("Serving Dialectical-TTS on http://%s:%d/v1/chat/completions", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 if __name__ == "__main__":
-    model, tokenizer = setup_model()
-    # The Trap Problem
-    # test_prompt = "A box contains 3 blue, 5 red, 2 green balls. Pull 3 without replacement. Probability of at least one red?"
-    test_prompt = """
-        You are on a game show with 3 doors. Behind one is a car; behind the others, goats.
-        1. You pick Door 1.
-        2. The host, Monty, walks toward the remaining doors.
-        3. He slips on a banana peel and accidentally crashes into Door 2, forcing it open.
-        4. Door 2 reveals a Goat.
-        5. Monty picks himself up and asks: "Do you want to switch to Door 3?"
-
-        Does switching to Door 3 increase your probability of winning, or does it remain 50/50? 
-        Derive the probability mathematically based strictly on the "Accidental" condition.
-        """    
-    
-    # test_prompt = """
-    #     A game show has 3 doors (D1, D2, D3). Car is behind one (random).
-    #     1. Player picks D1.
-    #     2. Host slips and ACCIDENTALLY opens D2.
-    #     3. D2 reveals a Goat.
-
-    #     CALCULATE THE PROBABILITY:
-    #     List all 3 initial possible worlds (Car at D1, Car at D2, Car at D3).
-    #     For each world, determine if the event "Host accidentally opens D2 AND reveals Goat" is possible.
-    #     If a world is impossible given the observation, eliminate it.
-    #     Count the remaining worlds where Car is at D1 vs Car is at D3.
-
-    #     Does switching to D3 increase the odds, or is it 50/50?
-    #     """
-
-    run_dialectical_tts(test_prompt, model, tokenizer)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    serve(port=8080)
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import random
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+mx = pytest.importorskip("mlx.core")
+qwen2 = pytest.importorskip("mlx_lm.models.qwen2")
+
+from mlx_lm.generate import generate_step
+from mlx_lm.models.cache import RotatingKVCache, make_prompt_cache
+
+import main
+
+
+def _tiny_qwen2(rope_scaling=None):
+    mx.random.seed(0)
+    args = qwen2.ModelArgs(
+        model_type="qwen2", hidden_size=64, num_hidden_layers=2, intermediate_size=128,
+        num_attention_heads=4, num_key_value_heads=2, rms_norm_eps=1e-6, vocab_size=64,
+        rope_theta=10000, tie_word_embeddings=True, rope_scaling=rope_scaling, max_position_embeddings=4096,
+    )
+    model = qwen2.Model(args)
+    mx.eval(model.parameters())
+    return model
+
+
+@pytest.fixture(scope="module")
+def model():
+    return _tiny_qwen2()
+
+
+@pytest.mark.parametrize("rope_scaling", [
+    None,
+    {"type": "linear", "factor": 2.0},
+    {"type": "llama3", "factor": 8.0, "original_max_position_embeddings": 1024},
+])
+def test_spliced_keys_match_fresh_prefill(rope_scaling):
+    model = _tiny_qwen2(rope_scaling)
+    assert main.can_splice_kv(model)
+    context = list(range(10, 40))
+    cache = main._prefill(model, context)
+    kv = [(c.keys[..., 20:30, :], c.values[..., 20:30, :]) for c in cache]
+
+    spliced = main._prefill(model, [3, 4, 5])
+    main.splice_kv(model, spliced, kv, 20)
+    fresh = main._prefill(model, [3, 4, 5] + context[20:30])
+
+    # Layer 0 keys depend only on token and position, so re-encoding must be exact
+    assert spliced[0].offset == fresh[0].offset == 13
+    assert mx.allclose(spliced[0].keys[..., :13, :], fresh[0].keys[..., :13, :], atol=1e-4).item()
+
+
+@pytest.mark.parametrize("rope_scaling", [
+    {"type": "yarn", "factor": 4.0, "original_max_position_embeddings": 1024},
+    {"type": "dynamic", "factor": 2.0},
+    {"type": "longrope", "original_max_position_embeddings": 1024, "short_factor": [1.0] * 8, "long_factor": [2.0] * 8},
+])
+def test_scaled_ropes_are_not_spliced(rope_scaling):
+    # Re-rotating these keys would scale them twice or use the wrong base
+    assert not main.can_splice_kv(_tiny_qwen2(rope_scaling))
+
+
+@pytest.mark.parametrize("text, answer", [
+    ("so \\boxed{\\frac{1}{2}}.", "\\frac{1}{2}"),                     # regex path
+    ("\\boxed{1} or rather \\boxed{ 2 }", "2"),                          # the last box wins
+    ("\\boxed{\\frac{\\sqrt{2}}{2}} done", "\\frac{\\sqrt{2}}{2}"),        # deeper nesting
+    ("\\boxed{42", "42"),                                                # unclosed
+    ("\\boxed{\\frac{1}{2", "\\frac{1}{2"),
+    ("no box, just 7 ", "no box, just 7"),
+])
+def test_extract_answer(text, answer):
+    assert main.extract_answer(text) == answer
+
+
+@pytest.mark.parametrize("a, b", [("\\frac{1}{2}", "0.5"), ("\\frac{1}{3}", "1/3"), ("\\dfrac{1}{3}", "0.3333333"),
+                                  ("0.3333333", "0.33333333"), ("1e400", "1E+400")])
+def test_same_value_settles_equal_numbers(a, b):
+    assert main._same_value(a, b) is True
+
+
+@pytest.mark.parametrize("a, b", [("1e400", "2"), ("inf", "1e400"), ("0.333", "1/3"), ("50/50", "1/2"),
+                                  ("50/50", "1"), ("50/50", "100/100"), ("Yes", "No")])
+def test_same_value_leaves_mismatches_to_the_model(a, b):
+    assert main._same_value(a, b) is None
+
+
+def test_huge_numbers_stay_text():
+    # Building these as Fractions would take minutes (or hit int()'s digit limit)
+    assert main._to_number("1e999999999") is None and main._to_number("9" * 5000) is None
+    assert main._vote_key("1e999999999") == "1e999999999"
+    assert main._same_value("1e999999999", "1e+999999999") is None
+    assert main._same_value("1e9999", "1E+9999") is True
+
+
+def test_vote_key_merges_only_real_numbers():
+    assert main._vote_key("0.5") == main._vote_key("\\frac{1}{2}") == main._vote_key("$\\dfrac{1}{2}$")
+    assert main._vote_key("50/50") != main._vote_key("1")
+    assert main._vote_key("50/50") != main._vote_key("100/100")
+
+
+def test_two_agree_needs_real_boxed_answers():
+    assert main._two_agree(["so \\boxed{\\frac{1}{2}}", "\\boxed{0.5}", None])
+    assert main._two_agree(["\\boxed{2/3}", "\\boxed{\\dfrac{2}{3}}", None])
+    assert not main._two_agree(["put it in \\boxed{}", "write \\boxed{}", None])
+    assert not main._two_agree(["... ends with 1/2", "\\boxed{1/2}", None])
+
+
+def _stops_at(segments):
+    stop = main.BoxedStop()
+    return next((i for i, segment in enumerate(segments) if stop(segment)), None)
+
+
+def test_boxed_stop_fires_when_the_answer_closes():
+    assert _stops_at(["The answer is \\bo", "xed{\\frac{1}", "{3}", "} and more"]) == 3
+
+
+def test_boxed_stop_skips_empty_boxes():
+    assert _stops_at(["Put the answer in \\boxed{}.", " Then \\boxed{ ", "} again", "\\boxed{2", "/3}"]) == 4
+    assert _stops_at(["\\boxed{} so \\boxed{7}"]) == 0
+    assert _stops_at(["\\boxed{ }", " no answer yet"]) is None
+
+
+# Test vocabulary: 60-62 spell a box, 63 is EOS, everything else a letter
+_PIECES = {60: "\\boxed{", 61: "7", 62: "}"}
+
+
+class _Detokenizer:
+    def __init__(self): self.text = self.last_segment = ""
+    def add_token(self, token):
+        self.last_segment = _PIECES.get(token, chr(ord("a") + token % 26))
+        self.text += self.last_segment
+    def finalize(self): self.last_segment = ""
+
+
+class _Tokenizer:
+    eos_token_ids = frozenset({63})
+    @property
+    def detokenizer(self): return _Detokenizer()
+    def apply_chat_template(self, messages, **kwargs): return "".join(m["content"] for m in messages)
+    def encode(self, text, add_special_tokens=True): return [ord(c) % 60 for c in text]
+
+
+def _scripted(*tokens, then=5):
+    """Sampler that emits `tokens` in order, then `then` forever."""
+    script = iter(tokens)
+    return lambda logprobs: mx.array([next(script, then)])
+
+
+def _greedy_sampler(logprobs):
+    return mx.argmax(logprobs, axis=-1)
+
+
+def test_generate_batch_spans_match_fresh_prefill(model):
+    head = [1, 2, 3, 4, 5]
+    prompts = [[10, 11, 12], [20, 21], [30, 31, 32, 33], [40]]
+    # Rows that end on EOS, on a closed box, on the token limit, and greedily
+    samplers = [_scripted(6, 7, 63), _scripted(8, 60, 61, 62), _scripted(), _greedy_sampler]
+    caches = [main._prefill(model, head) for _ in prompts]
+    texts, spans = main.generate_batch(model, _Tokenizer(), prompts, samplers, max_tokens=12,
+                                       caches=caches, return_kv=True)
+
+    assert texts[:3] == ["gh", "i\\boxed{7}", "f" * 12]
+    assert [len(ids) for ids, _, _ in spans[:3]] == [2, 4, 12]
+    for prompt, (ids, kv, start) in zip(prompts, spans):
+        assert start == len(head) + len(prompt)
+        fresh = main._prefill(model, head + prompt + ids)
+        for (keys, values), c in zip(kv, fresh):
+            assert keys.shape[-2] == len(ids)
+            assert mx.allclose(keys, c.keys[..., start:start + len(ids), :], atol=1e-4).item()
+            assert mx.allclose(values, c.values[..., start:start + len(ids), :], atol=1e-4).item()
+
+
+def test_generate_batch_cancels_the_last_row(model):
+    prompts = [[10, 11], [20, 21], [30, 31]]
+    samplers = [_scripted(60, 61, 62), _scripted(6, 6, 6, 60, 61, 62), _scripted()]
+    texts, spans = main.generate_batch(model, _Tokenizer(), prompts, samplers, max_tokens=40,
+                                       return_kv=True, stop_when=main._two_agree)
+
+    assert texts == ["\\boxed{7}", "ggg\\boxed{7}", None]
+    assert spans[2] is None
+    assert spans[1][0] == [6, 6, 6, 60, 61, 62]
+
+
+class _Verdicts:
+    """Stand-in for `generate` in the equivalence check: always replies `reply`."""
+    def __init__(self, reply): self.reply, self.calls = reply, []
+    def __call__(self, model, tokenizer, prompt, **kwargs):
+        self.calls.append(kwargs["max_tokens"])
+        return self.reply
+
+
+def _stub_generate(monkeypatch, reply):
+    verdicts = _Verdicts(reply)
+    monkeypatch.setattr(main, "generate", verdicts)
+    return verdicts
+
+
+@pytest.mark.parametrize("answers, reply, consensus, asked", [
+    (["\\frac{1}{2}", "0.5", "1/2"], "", "\\frac{1}{2}", False),
+    (["0.3333333", "\\frac{1}{3}", "\\dfrac{1}{3}"], "", "\\frac{1}{3}", False),   # 2-of-3, odd one within tolerance
+    (["Yes", "yes", "No"], "YES", "Yes", True),
+    (["Yes", "yes", "No"], "NO", None, True),
+    (["A", "B", "C"], "YES\nYES\nNO", "A", True),   # three variants collapse on two equivalent pairs
+    (["A", "B", "C"], "YES\nNO\nNO", None, True),
+    (["Yes", "Door 3"], "YES", "Yes", True),          # two answers left after an early exit
+    (["Yes", "Door 3"], "NO", None, True),
+    (["2/3", "\\dfrac{2}{3}"], "", "2/3", False),
+    (["7"], "", None, False),                         # fewer than two answers go to the Arbiter
+    ([], "", None, False),
+])
+def test_find_consensus(model, monkeypatch, answers, reply, consensus, asked):
+    verdicts = _stub_generate(monkeypatch, reply)
+    assert main.find_consensus(answers, model, _Tokenizer()) == consensus
+    assert bool(verdicts.calls) == asked
+
+
+def test_check_equivalence_batch_reads_verdicts_in_order(model, monkeypatch):
+    verdicts = _stub_generate(monkeypatch, "1) yes\n2) NOT SURE")
+    pairs = [("0.5", "\\frac{1}{2}"), ("Yes", "Correct"), ("cat", "dog"), ("Door 3", "door 3")]
+    # Normalization settles the first and last pair; a missing verdict counts as NO
+    assert main.check_equivalence_batch(pairs, model, _Tokenizer()) == [True, True, False, True]
+    assert verdicts.calls == [8]   # one call for both undecided pairs
+
+
+def test_cycle_takes_an_early_exit_pair_as_consensus(model, monkeypatch):
+    texts = ["so \\boxed{2/3}", "\\boxed{\\dfrac{2}{3}}", None]
+    monkeypatch.setattr(main, "generate_batch", lambda *args: (texts, [None] * 3))
+    verdicts = _stub_generate(monkeypatch, "")
+    assert asyncio.run(main.arun_dialectical_tts("2/3?", model, _Tokenizer())) == "2/3"
+    assert not verdicts.calls
+
+
+def _greedy(model, prompt, cache, max_tokens):
+    steps = generate_step(mx.array(prompt), model, prompt_cache=cache, max_tokens=max_tokens,
+                          sampler=lambda logprobs: mx.argmax(logprobs, axis=-1))
+    return [int(token) for token, _ in steps]
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("window", [None, 100])
+def test_prompt_lookup_matches_greedy_decoding(model, seed, window):
+    rng = random.Random(seed)
+    # Repetitive context, so n-gram lookup finds drafts; 95 tokens put a 100-token window on the edge
+    context = [rng.randrange(60) for _ in range(19)] * 5
+    prompt = [1, 2, 3]
+
+    def cache():
+        if window is None: c = make_prompt_cache(model)
+        else: c = [RotatingKVCache(max_size=window, keep=4) for _ in model.layers]
+        main._extend(model, c, context)
+        return c
+
+    expected = _greedy(model, prompt, cache(), 50)
+    lookup_cache = cache()
+    responses = list(main.prompt_lookup_generate(model, _Tokenizer(), prompt, lookup_cache, context=context, max_tokens=50))
+    tokens = [r.token for r in responses]
+    assert tokens == expected[:len(tokens)]
+    # No rejected draft is left behind: the cache holds everything except the last token
+    assert lookup_cache[0].offset == len(context) + len(prompt) + len(tokens) - 1
+
+
+def test_arbiter_window_keeps_the_prompt(model):
+    trace = list(range(20, 50))
+    trace_cache = main._prefill(model, trace)
+    spans = [(trace[:10], None, None), (trace[10:], [(c.keys[..., 10:30, :], c.values[..., 10:30, :]) for c in trace_cache], 10)]
+    prefix_ids, problem, lead_ids, prompt = [1, 2, 3, 4, 5], [10, 11, 12], [[6], [7]], [8, 9]
+    context = prefix_ids + problem + lead_ids[0] + spans[0][0] + lead_ids[1] + spans[1][0]
+    keep = len(context) + len(prompt)
+
+    cache = main.build_arbiter_cache(model, prefix_ids, problem, lead_ids, spans, max_kv_size=keep + 16, keep=keep)
+    responses = list(main.prompt_lookup_generate(model, _Tokenizer(), prompt, cache, context=context, max_tokens=60))
+    assert cache[0].offset > cache[0].max_size   # decoding went past the window
+
+    # The prompt's KV never slid out, and the output matches greedy decoding on the same cache
+    fresh = main._prefill(model, context + prompt)
+    assert mx.allclose(cache[0].keys[..., :keep, :], fresh[0].keys[..., :keep, :], atol=1e-4).item()
+    reference = main.build_arbiter_cache(model, prefix_ids, problem, lead_ids, spans, max_kv_size=keep + 16, keep=keep)
+    tokens = [r.token for r in responses]
+    assert tokens == _greedy(model, prompt, reference, 60)[:len(tokens)]
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), main._ChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _post(server, payload):
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/v1/chat/completions",
+                                     data=json.dumps(payload).encode())
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server_answers_the_last_user_message(server, monkeypatch):
+    monkeypatch.setattr(main, "_run_cycle", lambda prompt, model, tokenizer: f"answer to {prompt}")
+    status, body = _post(server, {"messages": [{"role": "user", "content": "2+2?"}]})
+    assert status == 200 and body["choices"][0]["message"]["content"] == "answer to 2+2?"
+
+
+def test_server_rejects_content_parts(server):
+    status, body = _post(server, {"messages": [{"role": "user", "content": [{"type": "text", "text": "2+2?"}]}]})
+    assert status == 400 and "error" in body
+
+
+def test_server_reports_failed_cycles(server, monkeypatch):
+    def fail(*args): raise RuntimeError("out of memory")
+    monkeypatch.setattr(main, "_run_cycle", fail)
+    status, body = _post(server, {"messages": [{"role": "user", "content": "2+2?"}]})
+    assert status == 500 and "out of memory" in body["error"]["message"]